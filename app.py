@@ -1,8 +1,17 @@
+from contextlib import asynccontextmanager
 from fastapi import FastAPI
 from routes.export_space import reqExportSpace
+from services.confluence_api import close_confluence_client
+from services.download_file import close_download_client
 from fastapi.middleware.cors import CORSMiddleware
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    yield
+    await close_confluence_client()
+    await close_download_client()
+
+app = FastAPI(lifespan=lifespan)
 origins = ['*']
 app.add_middleware(
     CORSMiddleware,
@@ -1,7 +1,6 @@
 from services.confluence_api import get_confluence_space_id_by_key, get_confluence_homepage_id_by_space_id, get_confluence_children_by_parent_page_id_recursive
-from services.download_file import export_pdf_confluence_page_by_id
+from services.download_file import export_pdf_confluence_pages_by_ids
 from services.delete_files import delete_files_in_bucket
-from google.cloud import storage
 import os
 from fastapi import APIRouter
 from fastapi import status
@@ -40,15 +39,14 @@ async def export_pdf_confluence_space_to_gcs_bucket_by_key():
         space_key = os.getenv('SPACE_KEY')
         gcs_bucket_name = os.getenv('GCS_BUCKET_NAME')
         wait_time = int(os.getenv('WAIT_TIME_BEFORE_DOWNLOAD'))
-        print(f"Succesfully loaded environment variables: domain = {domain}, email = {email}, api_token is secret, space_key = {space_key}, gcs_bucket_name = {gcs_bucket_name} and wait_time (before downloading file from URL) = {wait_time}")
+        export_workers = int(os.getenv('EXPORT_WORKERS', 20))
+        print(f"Succesfully loaded environment variables: domain = {domain}, email = {email}, api_token is secret, space_key = {space_key}, gcs_bucket_name = {gcs_bucket_name}, wait_time (before downloading file from URL) = {wait_time} and export_workers = {export_workers}")
         
     except:
         return {"status":-1 , "msg":"Could not load environment variables", "data":str(e)}
     
     try:
         await delete_files_in_bucket(gcs_bucket_name)
-        storage_client = storage.Client()
-        storage_client.bucket(gcs_bucket_name)
         print(f"Bucket {gcs_bucket_name} cleaned succesfully.")
     
     except Exception as e:
@@ -57,33 +55,32 @@ async def export_pdf_confluence_space_to_gcs_bucket_by_key():
     try: 
         print(f"Starting Confluence space download as PDF...")
         #Get space id
-        space_id = get_confluence_space_id_by_key(domain, email, api_token, space_key)
+        space_id = await get_confluence_space_id_by_key(domain, email, api_token, space_key)
         print(f"Space ID: {space_id}")
 
         #Get homepage id
-        homepage_id = get_confluence_homepage_id_by_space_id(domain, email, api_token, space_id)
+        homepage_id = await get_confluence_homepage_id_by_space_id(domain, email, api_token, space_id)
         print(f"Homepage ID: {homepage_id}")
 
         #Get all children from the homepage
-        pages_ids_dict = get_confluence_children_by_parent_page_id_recursive(domain, email, api_token, homepage_id)
-        print(f"Page IDs and titles: {pages_ids_dict}")
+        pages = await get_confluence_children_by_parent_page_id_recursive(domain, email, api_token, homepage_id)
+        print(f"Page IDs and titles: {pages}")
+        
+        #Download pages with a pool of workers
+        pages_results = await export_pdf_confluence_pages_by_ids(
+            pages,
+            workers=export_workers,
+            domain=domain, 
+            email=email, 
+            api_token=api_token, 
+            output_path=None, 
+            gcs_bucket_name=gcs_bucket_name,
+            wait_time=wait_time)
         
         #Store status of pages
         pages_status = {}
-        
-        #Download pages
-        for page_id, page_title in pages_ids_dict.items():
-            #Download page
-            page_status = export_pdf_confluence_page_by_id(
-                domain=domain, 
-                email=email, 
-                api_token=api_token, 
-                page_id=page_id, 
-                page_title=page_title,
-                output_path=None, 
-                gcs_bucket_name=gcs_bucket_name,
-                wait_time=wait_time)
-            
+        for page_id, _ in pages:
+            page_status = pages_results[page_id]
             if page_status not in pages_status:
                 pages_status[page_status] = [page_id]
             else:
@@ -1,10 +1,109 @@
-from requests.auth import HTTPBasicAuth
-import requests
+from aiolimiter import AsyncLimiter
+from collections import OrderedDict
+from dotenv import load_dotenv
+import asyncio
+import httpx
+import orjson
+import os
 import re
 
+# Load the stored environment variables
+load_dotenv()
+
+#Meta tags holding the PDF export task and cloud IDs, matched in a single scan
+TASK_CLOUD_ID_REGEX = re.compile(r'<meta\s+name="ajs-(taskId|cloud-id)"\s+content="([^"]+)"')
+TASK_CLOUD_ID_KEYS = {'taskId': 'taskId', 'cloud-id': 'cloudId'}
+
+## CONFLUENCE API CLIENT
+
+#Throughput limits, kept just under Confluence Cloud's rate limits
+requests_per_second = int(os.getenv('CONFLUENCE_REQUESTS_PER_SECOND', 10))
+max_connections = int(os.getenv('CONFLUENCE_MAX_CONNECTIONS', 8))
+if requests_per_second < 1:
+    raise ValueError(f"CONFLUENCE_REQUESTS_PER_SECOND must be at least 1, got {requests_per_second}")
+if max_connections < 1:
+    raise ValueError(f"CONFLUENCE_MAX_CONNECTIONS must be at least 1, got {max_connections}")
+
+#Rendering body.export_view or a PDF export can take well over httpx's 5 second default.
+#No pool timeout: the semaphore already keeps callers from queueing on the pool
+client_timeout = httpx.Timeout(120.0, connect=10.0, pool=None)
+
+#Shared client, reused across all Confluence API calls to keep connections alive
+client = httpx.AsyncClient(
+    headers={"Accept": "application/json"},
+    limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections),
+    timeout=client_timeout,
+    http2=True
+)
+
+#Every outbound call must hold both before being sent
+rate_limiter = AsyncLimiter(requests_per_second, 1)
+semaphore = asyncio.Semaphore(max_connections)
+
+async def confluence_get(url: str, **kwargs) -> httpx.Response:
+    """
+    Sends a GET request through the shared client, respecting the concurrency and rate limits.
+
+    Args:
+        url (str): URL to request.
+        **kwargs: Extra arguments passed to httpx.AsyncClient.get (e.g. auth, headers).
+
+    Returns:
+        httpx.Response: The HTTP response
+    """
+    async with semaphore, rate_limiter:
+        return await client.get(url, **kwargs)
+
+#ETag and body of the most recently used responses, keyed by URL
+ETAG_CACHE_SIZE = 1024
+etag_cache = OrderedDict()
+
+async def confluence_get_cached(url: str, headers: dict = None, **kwargs) -> httpx.Response:
+    """
+    Sends a GET request through confluence_get, revalidating previous responses with their ETag.
+    If Confluence answers 304 Not Modified, the cached body is returned as a 200 response.
+
+    Args:
+        url (str): URL to request.
+        headers (dict): Extra headers for the request. Optional.
+        **kwargs: Extra arguments passed to httpx.AsyncClient.get (e.g. auth).
+
+    Returns:
+        httpx.Response: The HTTP response
+    """
+    headers = dict(headers or {})
+    cached = etag_cache.get(url)
+    if cached:
+        headers["If-None-Match"] = cached[0]
+    
+    response = await confluence_get(url, headers=headers, **kwargs)
+    
+    if response.status_code == 304 and cached:
+        response = httpx.Response(200, content=cached[1], request=response.request)
+    elif response.status_code == 200 and response.headers.get("ETag"):
+        cached = (response.headers["ETag"], response.content)
+    else:
+        return response
+    
+    #Mark as most recently used, evicting the least recently used responses
+    etag_cache[url] = cached
+    etag_cache.move_to_end(url)
+    while len(etag_cache) > ETAG_CACHE_SIZE:
+        etag_cache.popitem(last=False)
+    return response
+
+async def close_confluence_client():
+    """
+    Closes the shared Confluence API client. Called on app shutdown.
+    """
+    await client.aclose()
+
 ## CONFLUENCE API
 
-def get_confluence_space_id_by_key(domain: str, email: str, api_token: str, space_key: str) -> dict:
+#Values that do not change during a run, memoized per process
+space_id_cache = {}
+
+async def get_confluence_space_id_by_key(domain: str, email: str, api_token: str, space_key: str) -> dict:
     """
     Fetches space ID details from the Confluence API.
 
@@ -17,22 +116,17 @@ def get_confluence_space_id_by_key(domain: str, email: str, api_token: str, spac
     Returns:
         str: The ID of the space provided
     """
-
-    import base64
-    auth_string = f"{email}:{api_token}"
-    encoded_auth_string = base64.b64encode(auth_string.encode()).decode()
+    if (domain, space_key) in space_id_cache:
+        return space_id_cache[(domain, space_key)]
     
     url = f"https://{domain}/wiki/rest/api/space/{space_key}"
-    headers = {
-        "Authorization": f"Basic {encoded_auth_string}",
-        "Accept": "application/json"
-    }
-    
-    response = requests.get(url, headers=headers)
-    key_json = handle_json_errors(response)
+    response = await confluence_get(url, auth=(email, api_token))
+    response.raise_for_status()
+    key_json = orjson.loads(response.content)
+    space_id_cache[(domain, space_key)] = key_json['id']
     return key_json['id']
 
-def get_confluence_homepage_id_by_space_id(domain: str, email: str, api_token: str, space_id: str):
+async def get_confluence_homepage_id_by_space_id(domain: str, email: str, api_token: str, space_id: str):
     """
     Fetches a space's homepage ID from the Confluence API.
     Refer to: https://developer.atlassian.com/cloud/confluence/rest/v2/api-group-page/#api-spaces-id-pages-get
@@ -46,22 +140,19 @@ def get_confluence_homepage_id_by_space_id(domain: str, email: str, api_token: s
         s: ID of the homepage
     """
     url = f"https://{domain}/wiki/api/v2/spaces/{space_id}/pages"
-    auth = HTTPBasicAuth(email, api_token)
-    headers = {
-      "Accept": "application/json"
-    }
-    response = requests.request("GET", url, headers=headers, auth=auth)
-    handle_json_errors(response)
-    pages = response.json()['results']
+    response = await confluence_get_cached(url, auth=(email, api_token))
+    response.raise_for_status()
+    pages = orjson.loads(response.content)['results']
     for page in pages:
         if page['parentType'] is None:
             return page['id']
     return None
   
-def get_confluence_children_by_parent_page_id_recursive(domain: str, email: str, api_token: str, page_id: str):
+async def get_confluence_children_by_parent_page_id_recursive(domain: str, email: str, api_token: str, page_id: str):
     """
-    Fetches page's content from the Confluence API.
-    Refer to: https://developer.atlassian.com/cloud/confluence/rest/v2/api-group-page/#api-pages-id-get
+    Fetches all descendants of a page from the Confluence API.
+    Children of sibling pages are requested concurrently.
+    Refer to: https://developer.atlassian.com/cloud/confluence/rest/v2/api-group-children/#api-pages-id-children-get
     Args:
         domain (str): The Confluence instance domain (e.g., 'your-domain.atlassian.net').
         email (str): The email address of the Confluence user.
@@ -69,49 +160,52 @@ def get_confluence_children_by_parent_page_id_recursive(domain: str, email: str,
         page_id (str): The ID of the page to fetch content from.
 
     Returns:
-        dict: All page ids and titles
+        list: (page id, title) tuples of all descendants, each page followed by its own descendants
     """
     url = f"https://{domain}/wiki/api/v2/pages/{page_id}/children"
-    auth = HTTPBasicAuth(email, api_token)
-    headers = {
-      "Accept": "application/json"
-    }
-
-    response = requests.request("GET", url, headers=headers, auth=auth)
+    response = await confluence_get_cached(url, auth=(email, api_token))
     response.raise_for_status()
-    children = response.json()
+    children = orjson.loads(response.content)
     if not children or not children['results']:
-        return {}
+        return []
+
+    #Walk every child's subtree concurrently
+    subtrees = await asyncio.gather(*[
+        get_confluence_children_by_parent_page_id_recursive(domain, email, api_token, child['id'])
+        for child in children['results']
+    ])
 
-    pages_ids_dict = {}
-    for child in children['results']:
-        pages_ids_dict[child['id']] = child['title']
-        pages_ids_dict.update(get_confluence_children_by_parent_page_id_recursive(domain, email, api_token, child['id']))
+    pages = []
+    for child, subtree in zip(children['results'], subtrees):
+        pages.append((child['id'], child['title']))
+        pages.extend(subtree)
 
-    return pages_ids_dict
+    return pages
   
-def get_pdf_export_confluence_url(domain, email, api_token, page_id):
+async def get_pdf_export_confluence_url(domain, email, api_token, page_id):
     """
     Refer to: https://confluence.atlassian.com/confkb/rest-api-to-export-and-download-a-page-in-pdf-format-1388160685.html
     """
     # Construct the export URL
     url = f"https://{domain}/wiki/spaces/flyingpdf/pdfpageexport.action?pageId={page_id}&unmatched-route=true"
-    auth = HTTPBasicAuth(email, api_token)
     headers = {
         "X-Atlassian-Token": "no-check",
+        "Accept": "*/*"
     }
-    response = requests.get(url, headers=headers, auth=auth, allow_redirects=True)
+    response = await confluence_get(url, headers=headers, auth=(email, api_token), follow_redirects=True)
+    response.raise_for_status()
     task_cloud_ids = extract_task_and_cloud_id_from_html(response.text)
     if task_cloud_ids:
       download_url = f"https://{domain}/wiki/services/api/v1/download/pdf?taskId={task_cloud_ids['taskId']}&cloudId={task_cloud_ids['cloudId']}"
-      download_response = requests.get(download_url, auth=HTTPBasicAuth(email, api_token))
+      download_response = await confluence_get(download_url, headers={"Accept": "*/*"}, auth=(email, api_token))
+      download_response.raise_for_status()
       presigned_url = download_response.text
       return presigned_url
   
-def get_confluence_page_title_by_id(domain: str, email: str, api_token: str, page_id: str):
+async def get_confluence_page_meta(domain: str, email: str, api_token: str, page_id: str):
     """
-    Fetches page title from the Confluence API.
-    Refer to: https://developer.atlassian.com/cloud/confluence/rest/v2/api-group-page/#api-pages-id-get
+    Fetches a page's title and whether it is empty from the Confluence API, in a single request.
+    Refer to: https://developer.atlassian.com/cloud/confluence/rest/v1/api-group-content/#api-wiki-rest-api-content-id-get
     Args:
         domain (str): The Confluence instance domain (e.g., 'your-domain.atlassian.net').
         email (str): The email address of the Confluence user.
@@ -119,54 +213,14 @@ def get_confluence_page_title_by_id(domain: str, email: str, api_token: str, pag
         page_id (str): The ID of the page to fetch details for.
 
     Returns:
-        title: page title
-    """
-    url = f"https://{domain}/wiki/api/v2/pages/{page_id}"
-    auth = HTTPBasicAuth(email, api_token)
-    headers = {
-      "Accept": "application/json"
-    }
-    response = requests.request("GET", url, headers=headers, auth=auth)
-    response = handle_json_errors(response)
-    return response['title']
-  
-def get_confluence_page_content_by_id(domain: str, email: str, api_token: str, page_id: str):
-    """
-    Fetches page's content from the Confluence API.
-    Refer to: https://developer.atlassian.com/cloud/confluence/rest/v2/api-group-page/#api-pages-id-get
-    Args:
-        domain (str): The Confluence instance domain (e.g., 'your-domain.atlassian.net').
-        email (str): The email address of the Confluence user.
-        api_token (str): The API token for authentication.
-        page_id (str): The ID of the page to fetch content from.
-
-    Returns:
-        A string with content of the page
+        dict: Keys 'title' (str) and 'empty' (bool)
     """
     url = f"https://{domain}/wiki/rest/api/content/{page_id}?expand=body.export_view"
-    auth = HTTPBasicAuth(email, api_token)
-    headers = {
-      "Accept": "application/json"
-    }
-    response = requests.request("GET", url, headers=headers, auth=auth)
-    handle_json_errors(response)
-    page_content = response.json()['body']['export_view']['value']
-    return page_content
-
-def is_empty_confluence_page(domain: str, email: str, api_token: str, page_id: str):
-    """
-    Fetches page's content from the Confluence API and checks if it is empty.
-    Args:
-        domain (str): The Confluence instance domain (e.g., 'your-domain.atlassian.net').
-        email (str): The email address of the Confluence user.
-        api_token (str): The API token for authentication.
-        page_id (str): The ID of the page to fetch content from.
-
-    Returns:
-        A  boolean value
-    """
-    page_content = get_confluence_page_content_by_id(domain, email, api_token, page_id)
-    return (page_content == "<p />" or page_content == "")
+    response = await confluence_get(url, auth=(email, api_token))
+    response.raise_for_status()
+    page = orjson.loads(response.content)
+    page_content = page['body']['export_view']['value']
+    return {'title': page['title'], 'empty': page_content in ("", "<p />")}
 
 ## HELPER FUNCTIONS
 
@@ -180,35 +234,12 @@ def extract_task_and_cloud_id_from_html(html_string):
     Returns:
         A dictionary containing taskId and cloudId, or None if not found.
     """
-    # Regular expressions to match the meta tags
-    task_id_match = re.search(r'<meta\s+name="ajs-taskId"\s+content="([^"]+)"', html_string)
-    cloud_id_match = re.search(r'<meta\s+name="ajs-cloud-id"\s+content="([^"]+)"', html_string)
-
-    task_id = task_id_match.group(1) if task_id_match else None
-    cloud_id = cloud_id_match.group(1) if cloud_id_match else None
+    # Scan the HTML once, keeping the first match of each meta tag
+    task_cloud_ids = {}
+    for match in TASK_CLOUD_ID_REGEX.finditer(html_string):
+        task_cloud_ids.setdefault(TASK_CLOUD_ID_KEYS[match.group(1)], match.group(2))
+        if len(task_cloud_ids) == len(TASK_CLOUD_ID_KEYS):
+            return task_cloud_ids
 
-    if task_id and cloud_id:
-        return {'taskId': task_id, 'cloudId': cloud_id}
-    else:
-        print("taskId or cloudId not found in the HTML")
-        return None
-  
-def handle_json_errors(response):
-    """
-    Handles JSON parsing for an HTTP response, returning JSON data if successful or error details if not.
-
-    Args:
-        response (requests.Response): The HTTP response object to parse.
-
-    Returns:
-        dict: A dictionary containing the parsed JSON data if successful,
-        or an error message with response details if the JSON parsing fails or if the response status is not 200.
-    """
-    if response.status_code == 200:
-        try:
-            data = response.json()
-            return data
-        except ValueError:
-            return {"error": "Response is not JSON formatted", "details": response.text}
-    else:
-        return {"error": f"Request failed with status {response.status_code}", "details": response.text}
\ No newline at end of file
+    print("taskId or cloudId not found in the HTML")
+    return None
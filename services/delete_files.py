@@ -1,15 +1,31 @@
-from google.cloud import storage
+from services.gcs import storage_client
+import asyncio
+
+#Maximum number of calls in a single GCS batch request
+BATCH_SIZE = 100
+
+def delete_blobs_in_batches(client, bucket):
+    """
+    Deletes all blobs in a bucket using GCS batch requests, sending up to BATCH_SIZE deletions per HTTP round-trip.
+
+    Args:
+        client (storage.Client): Google Cloud Storage client.
+        bucket (storage.Bucket): Bucket to empty.
+
+    Returns:
+        int: Number of deleted blobs
+    """
+    blobs = list(bucket.list_blobs())  # List all files in the bucket
+    for start in range(0, len(blobs), BATCH_SIZE):
+        with client.batch():
+            bucket.delete_blobs(blobs[start:start + BATCH_SIZE])
+    return len(blobs)
 
 async def delete_files_in_bucket(bucket_name):
     try:
-        # Conexión a Google Cloud Storage
-        client = storage.Client()
-        bucket = client.bucket(bucket_name)
+        bucket = storage_client.bucket(bucket_name)
     
-        blobs = bucket.list_blobs()  # Listar todos los archivos en el bucket
-
-        for blob in blobs:
-            blob.delete()  # Eliminar archivo
-            print(f'File {blob.name} deleted from bucket {bucket_name}.')
+        deleted = await asyncio.to_thread(delete_blobs_in_batches, storage_client, bucket)  # Delete files
+        print(f'{deleted} files deleted from bucket {bucket_name}.')
     except Exception as e:
         return {"status":-1 , "msg":"Unknown", "data":e}
\ No newline at end of file
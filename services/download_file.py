@@ -1,43 +1,125 @@
 import requests
 import re
+import asyncio
+import aiofiles
+import functools
+import httpx
 import os
-import time
-from services.confluence_api import get_confluence_page_title_by_id, is_empty_confluence_page, get_pdf_export_confluence_url
-import time
-from google.cloud import storage
-import io
+from pathlib import Path
+from services.confluence_api import get_confluence_page_meta, get_pdf_export_confluence_url, client_timeout, rate_limiter
+from services.gcs import storage_client
 
-def download_pdf_from_presigned_url(url, output_path):
+#Presigned PDF transfers (including the GCS upload) can take much longer than an API call,
+#so they hold their own semaphore and client instead of the Confluence API slots
+max_downloads = int(os.getenv('MAX_CONCURRENT_DOWNLOADS', 8))
+if max_downloads < 1:
+    raise ValueError(f"MAX_CONCURRENT_DOWNLOADS must be at least 1, got {max_downloads}")
+download_semaphore = asyncio.Semaphore(max_downloads)
+download_client = httpx.AsyncClient(
+    limits=httpx.Limits(max_connections=max_downloads, max_keepalive_connections=max_downloads),
+    timeout=client_timeout
+)
+
+async def close_download_client():
+    """
+    Closes the presigned download client. Called on app shutdown.
+    """
+    await download_client.aclose()
+
+#Characters that are not allowed in filenames
+NON_WORD_REGEX = re.compile(r'\W+')
+
+#Size of each chunk read from a download stream
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+
+#Size of each request of a resumable GCS upload, must be a multiple of 256 KiB
+UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024
+
+#Seconds to wait between polls of a presigned URL, the last one is repeated
+PDF_POLL_DELAYS = (1, 1, 2, 2, 4, 4, 8)
+
+#Number of times a page export is attempted
+DOWNLOAD_ATTEMPTS = 3
+
+#Seconds to wait before retrying a failed attempt, doubled on every attempt
+RETRY_BASE_DELAY = 10
+
+async def wait_before_retry(attempt, reason, response=None, retry_delay=None):
+    """
+    Logs a failed attempt and backs off before the next one, honouring Retry-After on rate limited responses.
+
+    Args:
+        attempt (int): Index of the failed attempt, starting at 0
+        reason (str): Why the attempt failed
+        response (httpx.Response): Response of the failed request. Optional.
+        retry_delay (int): Seconds to wait instead of the exponential backoff. Optional.
+    """
+    if attempt + 1 >= DOWNLOAD_ATTEMPTS:
+        print(f"Attempt {attempt + 1} failed: {reason}. No attempts left.")
+        return
+    
+    if retry_delay is None:
+        retry_delay = RETRY_BASE_DELAY * 2 ** attempt
+    if response is not None and response.status_code == 429:
+        retry_after = response.headers.get('Retry-After', '')
+        if retry_after.isdigit():
+            retry_delay = int(retry_after)
+    
+    print(f"Attempt {attempt + 1} failed: {reason}. Retrying in {retry_delay} seconds...")
+    await asyncio.sleep(retry_delay)
+
+async def download_pdf_when_ready(url, max_wait, download):
+    """
+    Polls a pre-signed URL with increasing delays, downloading the file as soon as it is available.
+    Every poll is a download attempt, so the response that first answers 200 is the one saved
+    and the file is only fetched once.
+
+    Args:
+        url (str): Pre-signed URL of the file
+        max_wait (int): Maximum number of seconds to wait for the file
+        download (callable): Async function taking the URL and returning {"statusCode": ...}
+        
+    Returns:
+        Status code of the last download attempt. 200 is successful.
+    """
+    download_url = {"statusCode": None}
+    waited = 0
+    poll = 0
+    while waited < max_wait:
+        #Never poll past max_wait
+        delay = min(PDF_POLL_DELAYS[min(poll, len(PDF_POLL_DELAYS) - 1)], max_wait - waited)
+        await asyncio.sleep(delay)
+        waited += delay
+        poll += 1
+        
+        async with download_semaphore, rate_limiter:
+            download_url = await download(url)
+        if download_url['statusCode'] == 200:
+            break
+    return download_url
+
+async def download_pdf_from_presigned_url(url, output_path):
     """
     Authenticates with a server to retrieve a pre-signed URL and downloads a file.
 
     Args:
         url (str): URL for download request
-        output_path (str): Path, including filename, where PDF should be downloaded
+        output_path (str): Path, including filename ending in .pdf, where PDF should be downloaded.
+                           Its directory must already exist.
         
     Return:
         Status code. 200 is succesful
     """
-    #Get path and filename
-    directory = os.path.dirname(output_path)
-    if not os.path.exists(directory):
-        os.makedirs(directory)
-
-    #Make sure filename ends in .pdf
-    filename = os.path.basename(output_path)
-    if not filename.lower().endswith('.pdf'):
-        filename += '.pdf'
-    output_path = f"{directory}/{filename}"
-        
-    response = requests.get(url, stream=True)
+    filename = Path(output_path).name
     
-    if response.status_code == 200:
-        with open(output_path, 'wb') as file:
-            for chunk in response.iter_content(chunk_size=8192):
-                file.write(chunk)
-        print(f"File downloaded successfully and saved as {filename}")  
-    else:
-        print(f"Failed to download {filename}. Status code: {response.status_code}")
+    async with download_client.stream("GET", url) as response:
+        if response.status_code == 200:
+            async with aiofiles.open(output_path, 'wb') as file:
+                async for chunk in response.aiter_bytes(DOWNLOAD_CHUNK_SIZE):
+                    await file.write(chunk)
+            print(f"File downloaded successfully and saved as {filename}")  
+        else:
+            print(f"Failed to download {filename}. Status code: {response.status_code}")
     
     return {"statusCode": response.status_code}    
 
@@ -59,30 +141,24 @@ def download_pdf_from_presigned_url_to_gcs_bucket(url, filename, gcs_bucket_name
     if not filename.lower().endswith('.pdf'):
         filename += '.pdf'
         
-    # Perform the request to get the file content
-    response = requests.get(url, stream=True)
-    
-    if response.status_code == 200:
-        # Initialize the Google Cloud Storage client
-        storage_client = storage.Client()
-        bucket = storage_client.bucket(gcs_bucket_name)
-        blob = bucket.blob(filename)
-        
-        # Use an in-memory BytesIO buffer to hold the file content temporarily
-        with io.BytesIO() as file_buffer:
-            for chunk in response.iter_content(chunk_size=8192):
-                file_buffer.write(chunk)
+    # Perform the request to get the file content, streaming it straight into the upload
+    # A stalled transfer must not hold its thread and download slot forever
+    with requests.get(url, stream=True, timeout=(client_timeout.connect, client_timeout.read)) as response:
+        if response.status_code == 200:
+            bucket = storage_client.bucket(gcs_bucket_name)
+            blob = bucket.blob(filename, chunk_size=UPLOAD_CHUNK_SIZE)
             
-            # Reset buffer position to the beginning
-            file_buffer.seek(0)
+            # Upload from the raw response stream, without buffering the whole file.
+            # Large or unsized files go up in UPLOAD_CHUNK_SIZE pieces instead of the client's 100 MiB default
+            response.raw.decode_content = True
+            # Content-Length only matches the decoded size when the body is not compressed
+            size = None if response.headers.get('Content-Encoding') else int(response.headers.get('Content-Length', 0)) or None
+            blob.upload_from_file(response.raw, content_type='application/pdf', size=size)
             
-            # Upload directly from the buffer
-            blob.upload_from_file(file_buffer, content_type='application/pdf')
+            print(f"File downloaded successfully and saved to GCS bucket {gcs_bucket_name} as {filename}")
         
-        print(f"File downloaded successfully and saved to GCS bucket {gcs_bucket_name} as {filename}")
-    
-    else:
-        print(f"Failed to download {filename}. Status code: {response.status_code}")
+        else:
+            print(f"Failed to download {filename}. Status code: {response.status_code}")
     
     return {"statusCode": response.status_code}
       
@@ -97,9 +173,9 @@ def convert_title_to_filename(title):
     Returns:
         str: The converted filename with spaces replaced by underscores and non-word characters removed.
     """
-    return re.sub(r'\W+', '', title.strip().replace(' ', '_'))
+    return NON_WORD_REGEX.sub('', title.strip().replace(' ', '_'))
   
-def export_pdf_confluence_page_by_id(
+async def export_pdf_confluence_page_by_id(
     domain, 
     email, 
     api_token, 
@@ -125,53 +201,110 @@ def export_pdf_confluence_page_by_id(
         str: Status of the downloaded page: 'EMPTY_PAGE', 'DOWNLOAD_SUCCESFUL', 'DOWNLOAD_FAILED'
     """
     
-    #Get page title if not provided
-    if not page_title:
-        page_title = get_confluence_page_title_by_id(domain, email, api_token, page_id)
-    
-    #File page title, formatted and ending in confluencePageId=page_id   
-    file_page_title = f"{convert_title_to_filename(page_title)}_confluencePageId={page_id}"
-    
-    #Check if it is an empty page
-    if is_empty_confluence_page(domain, email, api_token, page_id):
-        print(f"{file_page_title} is an empty page.")
-        return 'EMPTY_PAGE'
-
     #Wait time cannot be 0
     if not wait_time or wait_time == 0:
         wait_time = 15
         
-    #Try 3 times
-    for attempt in range(3):
-        #Generate the presigned download URL
-        url = get_pdf_export_confluence_url(domain, email, api_token, page_id)
-        
-        #To avoid file not found error, wait a bit before downloading from the URL
-        time.sleep(wait_time)
-        
-        #Download the file, and store the status code
-        
-        #If there is a bucket specified, download to bucket
-        if gcs_bucket_name:    
-            download_url = download_pdf_from_presigned_url_to_gcs_bucket(url=url, filename=file_page_title, gcs_bucket_name=gcs_bucket_name)
-            status_code = download_url['statusCode']
+    #Try DOWNLOAD_ATTEMPTS times
+    page_meta = None
+    for attempt in range(DOWNLOAD_ATTEMPTS):
+        try:
+            #Get page title and emptiness in a single request, retried like the export itself
+            if page_meta is None:
+                page_meta = await get_confluence_page_meta(domain, email, api_token, page_id)
+                
+                #Use fetched page title if not provided
+                if not page_title:
+                    page_title = page_meta['title']
+                
+                #File page title, formatted and ending in confluencePageId=page_id   
+                file_page_title = f"{convert_title_to_filename(page_title)}_confluencePageId={page_id}"
+                
+                #Check if it is an empty page
+                if page_meta['empty']:
+                    print(f"{file_page_title} is an empty page.")
+                    return 'EMPTY_PAGE'
+                
+                #If there is a bucket specified, download to bucket
+                if gcs_bucket_name:
+                    download = functools.partial(asyncio.to_thread, download_pdf_from_presigned_url_to_gcs_bucket, filename=file_page_title, gcs_bucket_name=gcs_bucket_name)
+                
+                #If not, download to output_path, preparing the output directory once, before any attempt
+                else:
+                    #If no output_path, then set to a value
+                    output_dir = Path(output_path or 'confluence_downloads/')
+                    output_dir.mkdir(parents=True, exist_ok=True)
+                    download = functools.partial(download_pdf_from_presigned_url, output_path=output_dir / f"{file_page_title}.pdf")
+            
+            #Generate the presigned download URL
+            url = await get_pdf_export_confluence_url(domain, email, api_token, page_id)
             
-        #If not, download to output_path
-        else: 
-            #If no output_path, then set to a value
-            if not output_path:
-                output_path = 'confluence_downloads/'
-            #Make sure output_path ends in /
-            output_path = output_path + "/" if not output_path.endswith("/") else output_path
+            #Without task and cloud IDs there is nothing to poll, wait before asking for a new export
+            if not url:
+                await wait_before_retry(attempt, f"PDF export task not found for {file_page_title}", retry_delay=wait_time)
+                continue
+            
+            #To avoid file not found error, poll the URL until the PDF is ready, downloading it on the first success
+            download_url = await download_pdf_when_ready(url, wait_time, download)
+        
+        #Only retry errors that may be temporary
+        except httpx.HTTPStatusError as e:
+            if e.response.status_code != 429 and e.response.status_code < 500:
+                print(f"Attempt {attempt + 1} failed with status code {e.response.status_code}. Not retrying.")
+                return 'DOWNLOAD_FAILED'
+            await wait_before_retry(attempt, f"status code {e.response.status_code}", e.response)
+            continue
+        except (httpx.TransportError, requests.RequestException) as e:
+            await wait_before_retry(attempt, f"exception of {type(e)}: {e}")
+            continue
         
-            download_url = download_pdf_from_presigned_url(url=url, output_path=f"{output_path}{file_page_title}")  
-            status_code = download_url['statusCode']
+        status_code = download_url['statusCode']
         
         if status_code == 200:
             return 'DOWNLOAD_SUCCESFUL'
         else:
-            wait_time += 10 #Increase wait between url and download
-            print(f"Attempt {attempt + 1} failed with status code {status_code}. Retrying in 10 seconds...")
-            time.sleep(10)
+            wait_time += 10 #Increase polling time for the next attempt
+            print(f"Attempt {attempt + 1} failed: PDF not ready after {wait_time - 10} seconds (last status code {status_code}). Retrying...")
             
-    return 'DOWNLOAD_FAILED'
\ No newline at end of file
+    return 'DOWNLOAD_FAILED'
+
+async def export_pdf_confluence_pages_by_ids(pages, workers=20, **export_kwargs):
+    """
+    Exports many pages as PDFs from the Confluence API, using a bounded pool of workers.
+    Args:
+        pages (list): (page id, title) tuples of the pages to export.
+        workers (int): Number of pages exported at the same time. Must be at least 1.
+        **export_kwargs: Extra arguments passed to export_pdf_confluence_page_by_id (e.g. domain, gcs_bucket_name).
+
+    Returns:
+        dict: Keys: Page IDs, and Values: Status of the downloaded page: 'EMPTY_PAGE', 'DOWNLOAD_SUCCESFUL', 'DOWNLOAD_FAILED'
+    """
+    if workers < 1:
+        raise ValueError(f"Number of export workers must be at least 1, got {workers}")
+    
+    queue = asyncio.Queue()
+    for page in pages:
+        queue.put_nowait(page)
+    
+    pages_status = {}
+    
+    async def worker():
+        while True:
+            page_id, page_title = await queue.get()
+            try:
+                pages_status[page_id] = await export_pdf_confluence_page_by_id(page_id=page_id, page_title=page_title, **export_kwargs)
+            except Exception as e:
+                print(f"Page {page_id} failed with exception of {type(e)}: {e}")
+                pages_status[page_id] = 'DOWNLOAD_FAILED'
+            finally:
+                queue.task_done()
+    
+    #Workers are cancelled even if this coroutine is, e.g. when the client disconnects
+    tasks = [asyncio.create_task(worker()) for _ in range(min(workers, len(pages)))]
+    try:
+        await queue.join()
+    finally:
+        for task in tasks:
+            task.cancel()
+    
+    return pages_status
\ No newline at end of file
@@ -0,0 +1,6 @@
+from google.cloud import storage
+
+## GOOGLE CLOUD STORAGE
+
+#Shared client, built once so credentials and the HTTP session are reused across uploads and deletions
+storage_client = storage.Client()
\ No newline at end of file